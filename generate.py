@@ -1,16 +1,27 @@
 import yaml
-import json
-import re
+import orjson
 import sys
 import shutil
 import base64
 import io
 import time
+import random
 import requests
 import jsonschema
 import hashlib
 import pathlib
+import threading
+import urllib.parse
+import concurrent.futures
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError, SSLError
+from urllib3.util.retry import Retry
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 BOARDS_DIR = pathlib.Path('boards')
@@ -18,6 +29,31 @@ TEMPLATE_DIR =  pathlib.Path('page_template')
 OUTPUT_DIR =  pathlib.Path('out')
 CACHE_DIR = pathlib.Path('cache')
 
+MEMORY_UNITS = {
+    'KB': 1024,
+    'MB': 1024 * 1024,
+    'GB': 1024 * 1024 * 1024
+}
+
+THUMBNAIL_WORKERS = 16
+THUMBNAIL_WORKERS_PER_HOST = 2
+
+# Bump whenever generate_thumbnail() output changes to invalidate cached thumbnails
+THUMBNAIL_CACHE_VERSION = 2
+
+DOWNLOAD_ATTEMPTS = 3
+TRANSIENT_DOWNLOAD_ERRORS = (ProtocolError, ReadTimeoutError, SSLError)
+
+HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=THUMBNAIL_WORKERS,
+    pool_maxsize=THUMBNAIL_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504])
+)
+
+SESSION = requests.Session()
+SESSION.mount('http://', HTTP_ADAPTER)
+SESSION.mount('https://', HTTP_ADAPTER)
+
 BOARD_SCHEMA = {
     'type': 'object',
     'properties': {
@@ -45,28 +81,94 @@ BOARD_SCHEMA = {
     'additionalProperties': False
 }
 
+jsonschema.Draft7Validator.check_schema(BOARD_SCHEMA)
+BOARD_VALIDATOR = jsonschema.Draft7Validator(BOARD_SCHEMA)
+
 
 def parse_memory_size(size_str):
     if not size_str or size_str == '0':
         return 0
 
-    match = re.match(r'(\d+)\s*(KB|MB|GB)', size_str.upper())
-    if not match:
+    size_str = size_str.strip()
+    digits = len(size_str) - len(size_str.lstrip('0123456789'))
+
+    value = size_str[:digits]
+    unit = size_str[digits:].strip().upper()
+
+    if not value or unit not in MEMORY_UNITS:
         raise ValueError(f'Error: Invalid memory size format: "{size_str}"!')
 
-    value = int(match.group(1))
-    unit = match.group(2)
+    return int(value) * MEMORY_UNITS[unit]
+
+
+def fetch_image(image_url, cache_file):
+    etag_file = cache_file.with_suffix('.etag')
+    lastmod_file = cache_file.with_suffix('.lastmod')
+
+    headers = {}
+    if cache_file.exists():
+        if etag_file.exists():
+            headers['If-None-Match'] = etag_file.read_text(encoding='utf-8')
+        if lastmod_file.exists():
+            headers['If-Modified-Since'] = lastmod_file.read_text(encoding='utf-8')
+
+        if not headers:
+            return False
+
+    try:
+        req = SESSION.get(image_url, headers=headers, stream=True, timeout=10)
+    except requests.RequestException as e:
+        if not cache_file.exists():
+            raise
+
+        print_message(f'Could not revalidate "{image_url}" ({e}), using cached image: {cache_file}')
+        return False
+
+    with req as r:
+        if r.status_code >= 400 and cache_file.exists():
+            print_message(f'Could not revalidate "{image_url}" ({r.status_code} {r.reason}), using cached image: {cache_file}')
+            return False
+
+        r.raise_for_status()
+
+        if r.status_code == 304:
+            return False
+
+        partial_file = cache_file.with_suffix('.part')
 
-    if unit == 'KB':
-        return value * 1024
+        r.raw.decode_content = True
+        try:
+            with open(partial_file, 'wb') as f:
+                shutil.copyfileobj(r.raw, f)
 
-    if unit == 'MB':
-        return value * 1024 * 1024
+            partial_file.replace(cache_file)
+        except BaseException:
+            partial_file.unlink(missing_ok=True)
+            raise
 
-    if unit == 'GB':
-        return value * 1024 * 1024 * 1024
+        for validator_file, header in ((etag_file, 'ETag'), (lastmod_file, 'Last-Modified')):
+            if r.headers.get(header):
+                validator_file.write_text(r.headers[header], encoding='utf-8')
+            else:
+                validator_file.unlink(missing_ok=True)
+
+    return True
+
+
+def fetch_image_with_retry(image_url, cache_file):
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            return fetch_image(image_url, cache_file)
+        except TRANSIENT_DOWNLOAD_ERRORS as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                if not cache_file.exists():
+                    raise
+
+                print_message(f'Could not revalidate "{image_url}" ({e}), using cached image: {cache_file}')
+                return False
 
-    return 0
+            print_message(f'Download of "{image_url}" interrupted ({e}), retrying...')
+            time.sleep(random.uniform(1, 2 ** attempt))
 
 
 def generate_thumbnail(image_url, max_size=(64, 64), quality=85):
@@ -74,83 +176,69 @@ def generate_thumbnail(image_url, max_size=(64, 64), quality=85):
         return None
 
     cache_file = CACHE_DIR / hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+    thumbnail_cache_file = cache_file.with_name(f'{cache_file.name}.v{THUMBNAIL_CACHE_VERSION}.{max_size[0]}x{max_size[1]}.q{quality}.jpg.b64')
 
     try:
-        if not cache_file.exists():
-            print('\tFetching image... ', end='\r')
+        if fetch_image_with_retry(image_url, cache_file):
+            for stale_thumbnail in CACHE_DIR.glob(f'{cache_file.name}.*.jpg.b64'):
+                stale_thumbnail.unlink()
 
-            req = requests.get(image_url, stream=True, timeout=10)
+        if thumbnail_cache_file.exists():
+            return thumbnail_cache_file.read_text(encoding='utf-8')
 
-            total_size = int(req.headers.get('content-length', 0))
-            downloaded = 0
-            image_data = bytearray()
+        with Image.open(cache_file) as img:
+            img.draft('RGB', (max_size[0] * 2, max_size[1] * 2))
 
-            with req as r:
-                r.raise_for_status()
-                for chunk in r.iter_content(1024):
-                    downloaded += len(chunk)
-                    image_data.extend(chunk)
-                    print(f'\tFetching image... {downloaded / total_size:.0%}', end='\r')
-            print('', end='\r')
+            if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                img = img.convert('RGBA' if img.mode == 'P' else 'RGB')
 
-            open(cache_file, 'wb').write(image_data)
-        
-        else:
-            print(f'\tUsing cached image: {cache_file}')
+            img.thumbnail(max_size, Image.Resampling.BILINEAR)
 
-        with Image.open(cache_file) as img:
-            if img.mode in ('RGBA', 'LA', 'P'):
+            if img.mode in ('RGBA', 'LA'):
                 background = Image.new('RGB', img.size, (255, 255, 255))
-
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-
-                if img.mode in ('RGBA', 'LA'):
-                    background.paste(img, mask=img.split()[-1])
-                    img = background
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
             elif img.mode != 'RGB':
                 img = img.convert('RGB')
 
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-
             buffer = io.BytesIO()
             img.save(buffer, format='JPEG', quality=quality, optimize=True)
             buffer.seek(0)
 
-            return 'data:image/jpeg;base64,' + base64.b64encode(buffer.read()).decode('utf-8')
+            thumbnail = 'data:image/jpeg;base64,' + base64.b64encode(buffer.read()).decode('utf-8')
+
+        thumbnail_cache_file.write_text(thumbnail, encoding='utf-8')
+
+        return thumbnail
     except Exception as e:
-        print(f'\tError generating thumbnail: {e}')
+        print_message(f'Error generating thumbnail for "{image_url}": {e}')
         return None
 
 
-def validate(filepath):
-    print(f'Validating "{filepath.name}"...')
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
 
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            jsonschema.validate(instance=yaml.safe_load(f), schema=BOARD_SCHEMA)
 
-        return True
+def host_semaphore(url):
+    host = urllib.parse.urlparse(url).netloc
 
-    except yaml.YAMLError as e:
-        print(f'\tError parsing YAML: {e}')
-        return False
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.Semaphore(THUMBNAIL_WORKERS_PER_HOST)
 
-    except jsonschema.ValidationError as e:
-        print(f'\tError validating schema: {e.message}:')
-        return False
+        return _host_semaphores[host]
 
-    except jsonschema.SchemaError as e:
-        print(f'\tError in schema: {e.message}:')
-        return False
 
+def fetch_thumbnail(image_url):
+    with host_semaphore(image_url):
+        return generate_thumbnail(image_url)
 
-def parse(filepath):
-    print(f'Processing "{filepath.name}"...')
 
+def parse(filepath):
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            board_data = yaml.safe_load(f)
+        board_data = yaml.load(filepath.read_bytes(), Loader=YamlLoader)
+
+        BOARD_VALIDATOR.validate(board_data)
 
         board_data['flash_bytes'] = parse_memory_size(board_data.get('flash'))
         board_data['ram_bytes'] = parse_memory_size(board_data.get('ram'))
@@ -158,33 +246,64 @@ def parse(filepath):
         board_data.setdefault('connectivity', [])
         board_data.setdefault('connectors', [])
         board_data.setdefault('notes', '')
-        board_data.setdefault('thumbnail', None)
-
-        if board_data.get('image'):
-            board_data['thumbnail'] = None
-            for _ in range(3):
-                board_data['thumbnail'] = generate_thumbnail(board_data['image'])
-                if board_data['thumbnail']:
-                    break
-
-                time.sleep(5)
-
-            if board_data['thumbnail'] is None:
-                return False
+        board_data['thumbnail'] = None
 
         return board_data
 
     except yaml.YAMLError as e:
-        print(f'\tError parsing YAML: {e}')
+        print_message(f'Error parsing YAML in "{filepath.name}": {e}')
+        return False
+    except jsonschema.ValidationError as e:
+        print_message(f'Error validating schema of "{filepath.name}": {e.message}')
         return False
     except ValueError as e:
-        print(f'\tValue error: {e}')
+        print_message(f'Value error in "{filepath.name}": {e}')
         return False
     except Exception as e:
-        print(f'\tUnexpected error: {e}')
+        print_message(f'Unexpected error in "{filepath.name}": {e}')
         return False
 
 
+def print_message(message):
+    print(f'\n{message}' if sys.stdout.isatty() else message)
+
+
+def print_progress(label, done, total):
+    if sys.stdout.isatty():
+        print(f'\r{label}... {done}/{total}', end='\n' if done == total else '', flush=True)
+    elif done == total:
+        print(f'{label}... {done}/{total}')
+
+
+def copy_template(keep=()):
+    expected = set(keep)
+
+    for src in TEMPLATE_DIR.rglob('*'):
+        dst = OUTPUT_DIR / src.relative_to(TEMPLATE_DIR)
+        expected.add(dst)
+
+        if src.is_dir():
+            dst.mkdir(parents=True, exist_ok=True)
+            continue
+
+        src_stat = src.stat()
+        if dst.exists():
+            dst_stat = dst.stat()
+            if dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+                continue
+
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(src, dst)
+
+    for stale in OUTPUT_DIR.rglob('*'):
+        if stale.is_file() and stale not in expected:
+            stale.unlink()
+
+    for stale in sorted(OUTPUT_DIR.rglob('*'), reverse=True):
+        if stale.is_dir() and stale not in expected and not any(stale.iterdir()):
+            stale.rmdir()
+
+
 def main():
     if not BOARDS_DIR.exists():
         sys.exit(f'Error: Directory "{BOARDS_DIR}" not found!')
@@ -192,34 +311,52 @@ def main():
     if not TEMPLATE_DIR.exists():
         sys.exit(f'Error: Directory "{TEMPLATE_DIR}" not found!')
 
-    if OUTPUT_DIR.exists():
-        shutil.rmtree(OUTPUT_DIR)
-
     if not CACHE_DIR.exists():
         CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+    json_path = OUTPUT_DIR / 'board_data.json'
+    json_path.unlink(missing_ok=True)
+
     files = [filepath for filepath in BOARDS_DIR.glob("*.yaml") if not filepath.stem == '_template']
     files.sort()
 
-    valid = [validate(filepath) for filepath in files]
-
-    if False in valid:
-        sys.exit('\nErrors found during validation. Aborting!')
+    all_data = [None] * len(files)
 
-    all_data = [parse(filepath) for filepath in files]
+    for i, filepath in enumerate(files):
+        all_data[i] = parse(filepath)
+        print_progress('Processing boards', i + 1, len(files))
 
     if False in all_data:
         sys.exit('\nErrors found during processing. Aborting!')
 
-    json_path = OUTPUT_DIR / 'board_data.json'
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump({'data': all_data}, f, indent=2)
+    image_urls = {board_data['image'] for board_data in all_data if board_data.get('image')}
+    thumbnails = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as executor:
+        futures = {executor.submit(fetch_thumbnail, image_url): image_url for image_url in image_urls}
+
+        for future in concurrent.futures.as_completed(futures):
+            thumbnails[futures[future]] = future.result()
+            print_progress('Generating thumbnails', len(thumbnails), len(image_urls))
+
+    for board_data in all_data:
+        if not board_data.get('image'):
+            continue
+
+        board_data['thumbnail'] = thumbnails[board_data['image']]
+        if board_data['thumbnail'] is None:
+            print(f'Error: No thumbnail for "{board_data["name"]}"!')
+
+    if any(board_data.get('image') and board_data['thumbnail'] is None for board_data in all_data):
+        sys.exit('\nErrors found while generating thumbnails. Aborting!')
+
+    json_path.write_bytes(orjson.dumps({'data': all_data}, option=orjson.OPT_INDENT_2))
 
     print(f'Successfully wrote {len(all_data)} boards to "{json_path}"!')
 
-    shutil.copytree(TEMPLATE_DIR, OUTPUT_DIR, dirs_exist_ok=True)
+    copy_template(keep=[json_path])
 
 
 if __name__ == '__main__':